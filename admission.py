@@ -0,0 +1,248 @@
+from flask import request, jsonify, make_response
+from functools import wraps
+import threading
+import math
+import time
+import os
+import json
+
+# ====================== CONTROL DE ADMISIÓN ======================
+#
+# Limita por ruta cuántas peticiones caras (Rekognition, Textract, OCR, OpenAI)
+# pueden ejecutarse a la vez, para que una ráfaga de /compare_face o
+# /extract_text no ocupe todos los hilos del worker y las rutas baratas
+# (/api/paypal/credentials, /send-notification) no queden esperando detrás.
+#
+# Los límites son por proceso: con gunicorn cada worker lleva su propio
+# presupuesto. Se pueden sobrescribir sin tocar código con la variable de
+# entorno ADMISSION_LIMITS, p. ej.:
+#   ADMISSION_LIMITS='{"compare_face": {"concurrency": 2, "rate": 1, "burst": 3}}'
+
+# Número máximo de buckets por uid que se guardan por ruta antes de purgar
+MAX_BUCKETS = 10000
+
+
+def _load_overrides():
+    raw = os.getenv("ADMISSION_LIMITS")
+    if not raw:
+        return {}
+    try:
+        overrides = json.loads(raw)
+    except Exception as e:
+        print(f"ADMISSION_LIMITS inválido, se ignoran los límites personalizados: {e}")
+        return {}
+    if not isinstance(overrides, dict):
+        print("ADMISSION_LIMITS debe ser un objeto JSON, se ignoran los límites personalizados")
+        return {}
+    valid = {}
+    for name, limits in overrides.items():
+        if isinstance(limits, dict):
+            valid[name] = limits
+        else:
+            print(f"ADMISSION_LIMITS[{name!r}] debe ser un objeto JSON, se ignora")
+    return valid
+
+
+LIMIT_OVERRIDES = _load_overrides()
+
+
+class TokenBucket:
+    """Bucket de tokens clásico: `rate` tokens por segundo hasta `burst`."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Consume un token. Devuelve 0 si se admitió o los segundos a esperar."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RouteLimiter:
+    """
+    Presupuesto de una ruta: un semáforo de concurrencia y, opcionalmente,
+    un bucket de tokens global o uno por uid.
+    """
+
+    def __init__(self, name, concurrency=None, rate=None, burst=None,
+                 per_uid=False, max_wait=0):
+        self.name = name
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst if burst is not None else (max(1, math.ceil(rate)) if rate else None)
+        self.per_uid = per_uid
+        self.max_wait = max_wait
+
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.in_flight = 0
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _check_rate(self, key):
+        """Devuelve 0 si hay token disponible o los segundos hasta el siguiente."""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_BUCKETS:
+                    # Los buckets llenos equivalen a uno nuevo, se pueden descartar
+                    self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full(now)}
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            return bucket.take(now)
+
+    def acquire_slot(self):
+        """
+        Reserva un hueco de concurrencia. Devuelve None si se obtuvo o una
+        tupla (status, retry_after, mensaje) si hay que rechazar la petición.
+        No necesita leer el cuerpo, así que se comprueba antes que nada.
+        """
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            # Espera opcional y acotada; por defecto se rechaza de inmediato
+            if self.max_wait > 0:
+                self._count("queued")
+                acquired = self._slots.acquire(timeout=self.max_wait)
+            else:
+                acquired = False
+            if not acquired:
+                self._count("shed")
+                return 503, 1, "Servicio saturado, intenta de nuevo más tarde"
+        with self._lock:
+            self.in_flight += 1
+        return None
+
+    def check_rate(self, key):
+        """
+        Consume un token del bucket de `key` una vez obtenido el hueco. Si no
+        hay token, libera el hueco y devuelve la tupla de rechazo (429).
+        """
+        wait = self._check_rate(key)
+        if wait:
+            self.release()
+            self._count("shed")
+            return 429, wait, "Demasiadas solicitudes, intenta de nuevo más tarde"
+        self._count("admitted")
+        return None
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "rate": self.rate,
+                "burst": self.burst,
+                "per_uid": self.per_uid,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "shed": self.shed,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def admission_stats():
+    """Contadores de todas las rutas limitadas."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+def _request_uid():
+    uid = request.form.get("uid")
+    if not uid:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            uid = data.get("uid")
+    return str(uid).strip() if uid else None
+
+
+def limit_route(name, concurrency=None, rate=None, burst=None, per_uid=False, max_wait=0):
+    """
+    Decorador de control de admisión para una ruta.
+
+    - concurrency: máximo de peticiones simultáneas en este proceso (503 si se supera).
+    - rate / burst: bucket de tokens en peticiones por segundo (429 si se agota).
+    - per_uid: si es True el bucket de tokens se lleva por uid del formulario/JSON.
+    - max_wait: segundos que una petición puede esperar un hueco antes de
+      rechazarse; 0 significa rechazo inmediato.
+
+    Todos los valores se pueden sobrescribir con ADMISSION_LIMITS[name].
+    """
+    config = {
+        "concurrency": concurrency,
+        "rate": rate,
+        "burst": burst,
+        "per_uid": per_uid,
+        "max_wait": max_wait,
+    }
+    config.update({k: v for k, v in LIMIT_OVERRIDES.get(name, {}).items() if k in config})
+    limiter = RouteLimiter(name, **config)
+    with _limiters_lock:
+        _limiters[name] = limiter
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Primero el hueco de concurrencia: así se rechaza sin parsear el
+            # cuerpo (p. ej. la imagen de un multipart)
+            rejection = limiter.acquire_slot()
+            if not rejection:
+                try:
+                    key = (_request_uid() if limiter.per_uid and limiter.rate else None) or "*"
+                    rejection = limiter.check_rate(key)
+                except BaseException:
+                    # Un cuerpo mal formado (p. ej. 413 por demasiados campos)
+                    # no puede dejar el hueco ocupado
+                    limiter.release()
+                    raise
+            if rejection:
+                status, retry_after, message = rejection
+                response = jsonify({"error": message})
+                response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+                return response, status
+
+            streamed = False
+            try:
+                response = make_response(view(*args, **kwargs))
+                # En respuestas en streaming el trabajo ocurre al iterarlas:
+                # el hueco se libera cuando el servidor cierra la respuesta
+                if response.is_streamed:
+                    response.call_on_close(limiter.release)
+                    streamed = True
+                return response
+            finally:
+                if not streamed:
+                    limiter.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,309 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import threading
+import zipfile
+import time
+import os
+import json
+
+# ====================== ALTA MASIVA DE ROSTROS ======================
+#
+# Utilidades para registrar de una vez la plantilla completa de una agencia:
+# una sola consulta de duplicados, index_faces en paralelo con limitación
+# adaptativa, escrituras a Firestore por lotes y un checkpoint en disco para
+# poder reanudar un trabajo interrumpido.
+
+# Errores de Rekognition que indican que hay que bajar el ritmo
+THROTTLING_ERRORS = {
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+}
+
+# Firestore admite como máximo 500 operaciones por lote
+FIRESTORE_BATCH_SIZE = 400
+# Aunque el lote no esté lleno, se confirma al menos cada tantos segundos
+FIRESTORE_FLUSH_SECONDS = 5
+
+# Límite de Rekognition para imágenes enviadas como bytes
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_MANIFEST_BYTES = 1024 * 1024
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class AdaptiveThrottle:
+    """
+    Limita las llamadas por segundo a Rekognition (aumento aditivo,
+    reducción multiplicativa): cada llamada exitosa sube el ritmo un poco,
+    cada error de throttling lo reduce a la mitad.
+    """
+
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=50.0, step=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.step / self.rate)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Deja un hueco antes de la siguiente llamada
+            self._next_slot = max(self._next_slot, time.monotonic() + 1.0 / self.rate)
+
+
+def existing_face_uids(rekognition_client, collection_id):
+    """Recorre la colección una sola vez y devuelve el set de ExternalImageId."""
+    uids = set()
+    paginator = rekognition_client.get_paginator("list_faces")
+    for page in paginator.paginate(CollectionId=collection_id):
+        uids.update(face.get("ExternalImageId") for face in page["Faces"])
+    return uids
+
+
+def _uid_from_filename(filename):
+    return os.path.splitext(os.path.basename(filename))[0].strip()
+
+
+def entries_from_files(files, uids=None):
+    """
+    Convierte los archivos de un multipart en una lista de (uid, tamaño, abrir).
+    Si no se envían uids, se usa el nombre del archivo sin extensión. Las
+    imágenes no se leen aquí: `abrir()` devuelve el archivo cuando toca indexarlo.
+    """
+    if uids and len(uids) != len(files):
+        raise ValueError("La cantidad de uids no coincide con la cantidad de imágenes")
+    entries = []
+    for i, image_file in enumerate(files):
+        uid = uids[i].strip() if uids else _uid_from_filename(image_file.filename or "")
+        entries.append((uid, None, lambda image_file=image_file: image_file.stream))
+    return entries
+
+
+def entries_from_zip(archive):
+    """
+    Lista las imágenes de un zip abierto como (uid, tamaño, abrir). Si incluye
+    manifest.json ({"archivo.jpg": "uid"}) se usa para asignar los uids; si no,
+    el nombre del archivo es el uid. El zip debe seguir abierto mientras se indexa.
+    """
+    infos = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+    manifest_info = infos.get("manifest.json")
+    if manifest_info is None:
+        return [
+            (_uid_from_filename(name), info.file_size, lambda info=info: archive.open(info))
+            for name, info in infos.items()
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+
+    if manifest_info.file_size > MAX_MANIFEST_BYTES:
+        raise ValueError("manifest.json es demasiado grande")
+    manifest = json.loads(archive.read(manifest_info))
+    if not isinstance(manifest, dict):
+        raise ValueError("manifest.json debe ser un objeto {\"archivo\": \"uid\"}")
+    entries = []
+    for filename, uid in manifest.items():
+        info = infos.get(filename)
+        if info is None:
+            raise ValueError(f"El manifest hace referencia a un archivo inexistente: {filename}")
+        entries.append((str(uid).strip(), info.file_size, lambda info=info: archive.open(info)))
+    return entries
+
+
+def _read_image(size, open_image):
+    """Lee la imagen sin pasar de MAX_IMAGE_BYTES, aunque el tamaño declarado mienta."""
+    if size is not None and size > MAX_IMAGE_BYTES:
+        raise ValueError("La imagen supera el límite de 5 MB de Rekognition")
+    image = open_image()
+    try:
+        image_bytes = image.read(MAX_IMAGE_BYTES + 1)
+    finally:
+        image.close()
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        raise ValueError("La imagen supera el límite de 5 MB de Rekognition")
+    return image_bytes
+
+
+class Checkpoint:
+    """
+    Estado por uid de un trabajo masivo, guardado en JSON:
+    "indexed" (ya está en Rekognition) o "done" (también en Firestore).
+    Los hilos del pool lo actualizan a la vez, por eso va protegido con un lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, uid):
+        with self._lock:
+            return self.state.get(uid)
+
+    def mark(self, uids, status):
+        """Actualiza el estado de los uids y lo guarda en disco."""
+        with self._lock:
+            for uid in uids:
+                self.state[uid] = status
+            # Archivo temporal único para no pisar el de otro proceso con el mismo job_id
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.path)
+
+
+def _index_face(rekognition_client, collection_id, throttle, uid, image_bytes, max_retries=5):
+    for attempt in range(max_retries + 1):
+        throttle.wait()
+        try:
+            response = rekognition_client.index_faces(
+                CollectionId=collection_id,
+                Image={'Bytes': image_bytes},
+                ExternalImageId=uid,
+                DetectionAttributes=['DEFAULT']
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in THROTTLING_ERRORS and attempt < max_retries:
+                throttle.throttled()
+                continue
+            raise
+        throttle.success()
+        return response
+
+
+def enroll_faces(entries, rekognition_client, collection_id, db, reference_folder,
+                 checkpoint, max_workers=8, logger=None):
+    """
+    Registra cada (uid, tamaño, abrir) y va generando un dict de resultado
+    por uid: "indexed" en cuanto la cara entra en Rekognition y "enrolled"
+    cuando además se confirma en Firestore.
+
+    Los uids ya completados en el checkpoint se omiten; los que quedaron
+    indexados pero sin actualizar en Firestore solo se actualizan.
+    """
+    existing = existing_face_uids(rekognition_client, collection_id)
+    throttle = AdaptiveThrottle()
+    pending_commit = []
+    last_flush = time.monotonic()
+    seen = set()
+
+    def flush():
+        nonlocal last_flush
+        last_flush = time.monotonic()
+        if not pending_commit:
+            return []
+        batch_uids = list(pending_commit)
+        pending_commit.clear()
+        try:
+            batch = db.batch()
+            for uid in batch_uids:
+                batch.set(
+                    db.collection('trabajadores').document(uid),
+                    {"referenceAdded": True, "etapaRegistro": "ID_PENDING"},
+                    merge=True
+                )
+            batch.commit()
+        except Exception as e:
+            if logger:
+                logger.warning(f"No se pudo actualizar Firestore: {e}")
+            return [{"uid": uid, "status": "indexed", "firestore": False} for uid in batch_uids]
+        checkpoint.mark(batch_uids, "done")
+        return [{"uid": uid, "status": "enrolled"} for uid in batch_uids]
+
+    def flush_due():
+        return (len(pending_commit) >= FIRESTORE_BATCH_SIZE
+                or time.monotonic() - last_flush >= FIRESTORE_FLUSH_SECONDS)
+
+    def index_and_save(uid, image_bytes):
+        response = _index_face(rekognition_client, collection_id, throttle, uid, image_bytes)
+        if not response.get("FaceRecords"):
+            return False
+        # La imagen de referencia solo se guarda si la cara quedó indexada:
+        # /compare_face da por registrado a quien tenga el archivo
+        with open(os.path.join(reference_folder, f"{uid}.jpg"), 'wb') as f:
+            f.write(image_bytes)
+        # Se marca desde el propio hilo para que un trabajo interrumpido
+        # no pierda las caras que ya se indexaron
+        checkpoint.mark([uid], "indexed")
+        return True
+
+    def collect(in_flight):
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            uid = in_flight.pop(future)
+            try:
+                indexed = future.result()
+            except Exception as e:
+                if logger:
+                    logger.error(f"Error al indexar la cara de {uid}: {e}")
+                yield {"uid": uid, "status": "error", "error": f"Error al indexar la cara: {e}"}
+                continue
+            if not indexed:
+                yield {"uid": uid, "status": "error", "error": "No se detectó ningún rostro"}
+                continue
+            yield {"uid": uid, "status": "indexed"}
+            pending_commit.append(uid)
+        if flush_due():
+            yield from flush()
+
+    # Las imágenes se leen una a una y solo hay `max_workers` caras en vuelo;
+    # si el cliente se desconecta se cancelan las pendientes en vez de
+    # indexar toda la plantilla
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight = {}
+    try:
+        for uid, size, open_image in entries:
+            status = checkpoint.get(uid)
+            if not uid:
+                yield {"uid": uid, "status": "error", "error": "El UID no puede estar vacío"}
+                continue
+            if "/" in uid or "\\" in uid or uid.startswith("."):
+                yield {"uid": uid, "status": "error", "error": "UID inválido"}
+                continue
+            if uid in seen:
+                yield {"uid": uid, "status": "duplicate", "error": "UID repetido en la solicitud"}
+                continue
+            seen.add(uid)
+            if status == "done":
+                yield {"uid": uid, "status": "skipped", "message": "Ya registrado en un intento anterior"}
+                continue
+            if status == "indexed":
+                pending_commit.append(uid)
+                continue
+            if uid in existing:
+                yield {
+                    "uid": uid,
+                    "status": "duplicate",
+                    "error": "Ya hay una referencia facial registrada para este usuario."
+                }
+                continue
+            try:
+                image_bytes = _read_image(size, open_image)
+            except Exception as e:
+                yield {"uid": uid, "status": "error", "error": str(e)}
+                continue
+            in_flight[executor.submit(index_and_save, uid, image_bytes)] = uid
+            if len(in_flight) >= max_workers:
+                yield from collect(in_flight)
+        while in_flight:
+            yield from collect(in_flight)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    yield from flush()
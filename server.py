@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.auth.transport.requests import Request
@@ -10,6 +10,11 @@ import json
 from flask_cors import CORS
 import tempfile
 import boto3
+import uuid
+import zipfile
+from werkzeug.exceptions import RequestEntityTooLarge
+from admission import limit_route, admission_stats
+from bulk_enroll import enroll_faces, entries_from_files, entries_from_zip, Checkpoint
 
 app = Flask(__name__)
 CORS(app)  # Habilita CORS para todas las rutas
@@ -91,6 +96,15 @@ rekognition_client = boto3.client(
 REFERENCE_FOLDER = './reference_faces'
 os.makedirs(REFERENCE_FOLDER, exist_ok=True)
 
+# Checkpoints de las altas masivas, para poder reanudarlas
+BULK_JOBS_FOLDER = os.path.join(REFERENCE_FOLDER, '_bulk_jobs')
+os.makedirs(BULK_JOBS_FOLDER, exist_ok=True)
+
+# Límites de la petición de alta masiva. Cada trabajador con 'images' + 'uids'
+# ocupa dos partes del formulario; el zip no tiene ese límite.
+BULK_MAX_CONTENT_LENGTH = 500 * 1024 * 1024
+BULK_MAX_FORM_PARTS = 5000
+
 # ID de la colección de rostros
 COLLECTION_ID = "face_auth_collection"
 # ====================== FCM ======================
@@ -185,6 +199,7 @@ def send_notification():
 # ====================== IDENTIFICAR SERVICIO ======================
 
 @app.route('/identify-service', methods=['POST'])
+@limit_route('identify_service', concurrency=4, rate=5, burst=10)
 def identify_service():
     try:
         data = request.json
@@ -249,6 +264,7 @@ def ensure_collection_exists():
     except Exception as e:
         app.logger.error(f"Error al verificar/crear colección: {e}")
 @app.route('/add_reference_face', methods=['POST'])
+@limit_route('add_reference_face', concurrency=2, rate=1, burst=3, per_uid=True)
 def add_reference_face():
     app.logger.info("Request received for add_reference_face")
     if 'image' not in request.files:
@@ -308,7 +324,81 @@ def add_reference_face():
     return jsonify({"message": "Imagen de referencia guardada exitosamente", "uid": uid}), 200
 
 
+@app.route('/add_reference_faces_bulk', methods=['POST'])
+@limit_route('add_reference_faces_bulk', concurrency=1)
+def add_reference_faces_bulk():
+    """
+    Alta masiva de rostros de referencia. Acepta:
+      - un zip en el campo 'archive', opcionalmente con manifest.json
+        ({"archivo.jpg": "uid"}); es la opción para plantillas grandes, o
+      - varias imágenes en el campo 'images' (uid = nombre del archivo, o
+        una lista paralela en el campo 'uids'), hasta BULK_MAX_FORM_PARTS
+        partes del formulario.
+    Responde en streaming con una línea JSON por uid (application/x-ndjson).
+    Si se envía el mismo 'job_id' de un intento interrumpido, se reanuda
+    desde su checkpoint.
+    """
+    app.logger.info("Request received for add_reference_faces_bulk")
+
+    # Límites propios de esta ruta; deben fijarse antes de leer el formulario
+    request.max_content_length = BULK_MAX_CONTENT_LENGTH
+    request.max_form_parts = BULK_MAX_FORM_PARTS
+
+    archive = None
+    try:
+        job_id = request.form.get('job_id') or uuid.uuid4().hex
+        if not job_id.isalnum():
+            return jsonify({"error": "job_id inválido"}), 400
+
+        if 'archive' in request.files:
+            archive = zipfile.ZipFile(request.files['archive'].stream)
+            entries = entries_from_zip(archive)
+        elif 'images' in request.files:
+            entries = entries_from_files(
+                request.files.getlist('images'),
+                request.form.getlist('uids') or None
+            )
+        else:
+            return jsonify({"error": "No se proporcionaron imágenes"}), 400
+    except RequestEntityTooLarge:
+        return jsonify({
+            "error": "La solicitud es demasiado grande: máximo "
+                     f"{BULK_MAX_CONTENT_LENGTH // (1024 * 1024)} MB y {BULK_MAX_FORM_PARTS} campos. "
+                     "Para plantillas grandes envía un zip en 'archive' o divide el alta en varias solicitudes."
+        }), 413
+    except Exception as e:
+        if archive is not None:
+            archive.close()
+        app.logger.error(f"Error al leer las imágenes: {e}")
+        return jsonify({"error": f"Error al leer las imágenes: {e}"}), 400
+
+    if not entries:
+        if archive is not None:
+            archive.close()
+        return jsonify({"error": "No se proporcionaron imágenes"}), 400
+
+    checkpoint = Checkpoint(os.path.join(BULK_JOBS_FOLDER, f"{job_id}.json"))
+
+    def generate():
+        yield json.dumps({"job_id": job_id, "total": len(entries)}) + "\n"
+        try:
+            for result in enroll_faces(
+                entries, rekognition_client, COLLECTION_ID, db,
+                REFERENCE_FOLDER, checkpoint, logger=app.logger
+            ):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except Exception as e:
+            app.logger.error(f"Error en el alta masiva {job_id}: {e}")
+            yield json.dumps({"job_id": job_id, "error": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            if archive is not None:
+                archive.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route('/compare_face', methods=['POST'])
+@limit_route('compare_face', concurrency=2, rate=1, burst=3, per_uid=True)
 def compare_face():
     app.logger.info("Request received for compare_face")
     app.logger.info(f"Form data: {request.form}")
@@ -364,6 +454,7 @@ def compare_face():
     return jsonify({"match": True, "similarity": similarity, "message": "Las imágenes coinciden."}), 200
 
 @app.route('/extract_text', methods=['POST'])
+@limit_route('extract_text', concurrency=2, rate=1, burst=3)
 def extract_text():
     app.logger.info("Request received for extract_text")
 
@@ -399,5 +490,12 @@ def extract_text():
         app.logger.error(f"Error al procesar la imagen con Textract: {str(e)}")
         return jsonify({"error": f"Error al procesar la imagen con Textract: {str(e)}"}), 500
         
+# ====================== ADMISIÓN ======================
+
+@app.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """Contadores de peticiones admitidas, en cola y rechazadas por ruta"""
+    return jsonify(admission_stats()), 200
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,254 @@
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, jsonify
+from werkzeug.serving import BaseWSGIServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+from admission import limit_route, admission_stats
+
+
+def make_app(name, **limits):
+    """App mínima con una ruta cara limitada que espera a `gate` y una ruta barata."""
+    app = Flask(__name__)
+    gate = threading.Event()
+    started = threading.Semaphore(0)
+
+    @app.route('/slow', methods=['POST'])
+    @limit_route(name, **limits)
+    def slow():
+        started.release()
+        gate.wait(5)
+        return jsonify({"ok": True}), 200
+
+    @app.route('/cheap', methods=['GET'])
+    def cheap():
+        return jsonify({"ok": True}), 200
+
+    return app, gate, started
+
+
+def hold_slots(app, started, n, data=None):
+    """Lanza n peticiones a /slow y espera a que estén ejecutándose."""
+    results = []
+
+    def call():
+        results.append(app.test_client().post('/slow', data=data or {}).status_code)
+
+    threads = [threading.Thread(target=call) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for _ in range(n):
+        assert started.acquire(timeout=5)
+    return threads, results
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Servidor WSGI con un número fijo de hilos, como un worker gthread de gunicorn."""
+
+    def __init__(self, app, threads):
+        super().__init__("127.0.0.1", 0, app)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def cheap_latency_under_flood(name, limits, threads=4, flood=12, slow_seconds=0.4):
+    """
+    Levanta la app en un servidor con `threads` hilos, inunda /slow con
+    `flood` peticiones y mide cuánto tarda /cheap mientras tanto.
+    Devuelve (latencia sin carga, latencia con carga, códigos de /slow).
+    """
+    app = Flask(__name__)
+
+    def slow():
+        time.sleep(slow_seconds)
+        return jsonify({"ok": True}), 200
+
+    if limits is not None:
+        slow = limit_route(name, **limits)(slow)
+    app.add_url_rule('/slow', 'slow', slow, methods=['POST'])
+    app.add_url_rule('/cheap', 'cheap', lambda: (jsonify({"ok": True}), 200))
+
+    server = PooledWSGIServer(app, threads)
+    serving = threading.Thread(target=server.serve_forever, daemon=True)
+    serving.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    def timed_get(path):
+        begin = time.monotonic()
+        with urllib.request.urlopen(base + path, timeout=10) as response:
+            assert response.status == 200
+        return time.monotonic() - begin
+
+    codes = []
+
+    def post_slow():
+        try:
+            with urllib.request.urlopen(urllib.request.Request(base + '/slow', data=b'', method='POST'), timeout=10) as r:
+                codes.append((r.status, None))
+        except urllib.error.HTTPError as e:
+            codes.append((e.code, e.headers.get('Retry-After')))
+
+    try:
+        idle = timed_get('/cheap')
+        flooders = [threading.Thread(target=post_slow) for _ in range(flood)]
+        for t in flooders:
+            t.start()
+        time.sleep(0.1)
+        loaded = timed_get('/cheap')
+        for t in flooders:
+            t.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.pool.shutdown()
+    return idle, loaded, codes
+
+
+def test_cheap_route_latency_stays_flat_while_expensive_route_is_saturated():
+    idle, loaded, codes = cheap_latency_under_flood('test_flood', {"concurrency": 2})
+
+    assert loaded < idle + 0.15
+    assert sorted(code for code, _ in codes).count(200) == 2
+    assert all(code == 503 and retry_after == '1' for code, retry_after in codes if code != 200)
+    stats = admission_stats()['test_flood']
+    assert stats['admitted'] == 2
+    assert stats['shed'] == 10
+    assert stats['in_flight'] == 0
+
+
+def test_without_admission_control_cheap_route_waits_behind_expensive_ones():
+    # Control: sin limit_route los hilos se llenan con /slow y /cheap hace cola
+    idle, loaded, codes = cheap_latency_under_flood('test_flood_unlimited', None)
+
+    assert loaded > idle + 0.3
+    assert all(code == 200 for code, _ in codes)
+
+
+def test_excess_requests_are_shed_with_retry_after():
+    app, gate, started = make_app('test_saturated', concurrency=2)
+    threads, results = hold_slots(app, started, 2)
+    client = app.test_client()
+
+    try:
+        for _ in range(3):
+            response = client.post('/slow')
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '1'
+    finally:
+        gate.set()
+        for t in threads:
+            t.join()
+
+    assert results == [200, 200]
+    stats = admission_stats()['test_saturated']
+    assert stats['admitted'] == 2
+    assert stats['queued'] == 0
+    assert stats['shed'] == 3
+    assert stats['in_flight'] == 0
+
+
+def test_body_parse_error_releases_slot():
+    app, gate, started = make_app('test_bad_body', concurrency=1, rate=100, per_uid=True)
+    gate.set()
+    client = app.test_client()
+
+    # Más campos que MAX_FORM_PARTS: request.form lanza 413 al buscar el uid
+    fields = {f"campo{i}": "x" for i in range(app.config.get("MAX_FORM_PARTS") or 1000)}
+    fields["uid"] = "a"
+    response = client.post('/slow', data=fields, content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert admission_stats()['test_bad_body']['in_flight'] == 0
+
+    assert client.post('/slow', data={'uid': 'a'}).status_code == 200
+
+
+def test_queued_request_is_admitted_when_a_slot_frees_up():
+    app, gate, started = make_app('test_queued', concurrency=1, max_wait=2)
+    threads, results = hold_slots(app, started, 1)
+
+    threading.Timer(0.1, gate.set).start()
+    response = app.test_client().post('/slow')
+    for t in threads:
+        t.join()
+
+    assert response.status_code == 200
+    stats = admission_stats()['test_queued']
+    assert stats['admitted'] == 2
+    assert stats['queued'] == 1
+    assert stats['shed'] == 0
+
+
+def test_rate_limit_is_per_uid_and_returns_429():
+    app, gate, started = make_app('test_rate', rate=0.1, burst=1, per_uid=True)
+    gate.set()
+    client = app.test_client()
+
+    assert client.post('/slow', data={'uid': 'a'}).status_code == 200
+    response = client.post('/slow', data={'uid': 'a'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.post('/slow', data={'uid': 'b'}).status_code == 200
+
+    stats = admission_stats()['test_rate']
+    assert stats['admitted'] == 2
+    assert stats['shed'] == 1
+
+
+def test_concurrency_rejection_does_not_consume_rate_budget():
+    app, gate, started = make_app('test_no_token', concurrency=1, rate=0.1, burst=2)
+    threads, results = hold_slots(app, started, 1)
+    client = app.test_client()
+
+    assert client.post('/slow').status_code == 503
+    gate.set()
+    for t in threads:
+        t.join()
+    assert client.post('/slow').status_code == 200
+
+
+def test_streamed_response_holds_slot_until_closed():
+    app = Flask(__name__)
+
+    @app.route('/stream', methods=['POST'])
+    @limit_route('test_stream', concurrency=1)
+    def stream():
+        def generate():
+            yield "a\n"
+            yield "b\n"
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    client = app.test_client()
+    first = client.post('/stream', buffered=False)
+    assert admission_stats()['test_stream']['in_flight'] == 1
+    assert client.post('/stream').status_code == 503
+
+    assert first.get_data() == b"a\nb\n"
+    first.close()
+    assert admission_stats()['test_stream']['in_flight'] == 0
+    assert client.post('/stream').status_code == 200
+
+
+def test_invalid_overrides_are_ignored(monkeypatch):
+    monkeypatch.setenv('ADMISSION_LIMITS', '{"compare_face": 2, "extract_text": {"concurrency": 1}}')
+    assert admission._load_overrides() == {"extract_text": {"concurrency": 1}}
+
+    monkeypatch.setenv('ADMISSION_LIMITS', '[1, 2]')
+    assert admission._load_overrides() == {}
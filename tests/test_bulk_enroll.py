@@ -0,0 +1,220 @@
+import io
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bulk_enroll
+from bulk_enroll import Checkpoint, enroll_faces, entries_from_zip
+
+
+class FakeRekognition:
+    """Colección en memoria; `fail` permite devolver errores por uid."""
+
+    def __init__(self, existing=(), fail=None, no_face=()):
+        self.faces = set(existing)
+        self.fail = fail or {}
+        self.no_face = set(no_face)
+        self.calls = []
+
+    def get_paginator(self, name):
+        assert name == "list_faces"
+        faces = [{"ExternalImageId": uid} for uid in self.faces]
+        return type("Paginator", (), {"paginate": lambda _self, **kwargs: [{"Faces": faces}]})()
+
+    def index_faces(self, CollectionId, Image, ExternalImageId, DetectionAttributes):
+        self.calls.append(ExternalImageId)
+        errors = self.fail.get(ExternalImageId)
+        if errors:
+            raise ClientError({"Error": {"Code": errors.pop(0), "Message": "fake"}}, "IndexFaces")
+        if ExternalImageId in self.no_face:
+            return {"FaceRecords": []}
+        self.faces.add(ExternalImageId)
+        return {"FaceRecords": [{"Face": {"ExternalImageId": ExternalImageId}}]}
+
+
+class FakeFirestore:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.committed = []
+
+    def collection(self, name):
+        assert name == "trabajadores"
+        return self
+
+    def document(self, uid):
+        return uid
+
+    def batch(self):
+        db = self
+
+        class Batch:
+            def __init__(self):
+                self.uids = []
+
+            def set(self, uid, data, merge):
+                assert data == {"referenceAdded": True, "etapaRegistro": "ID_PENDING"} and merge
+                self.uids.append(uid)
+
+            def commit(self):
+                if db.fail:
+                    raise RuntimeError("Firestore no disponible")
+                db.committed.append(list(self.uids))
+
+        return Batch()
+
+
+def entries(*uids):
+    return [(uid, None, lambda: io.BytesIO(b"imagen")) for uid in uids]
+
+
+@pytest.fixture(autouse=True)
+def fast_throttle(monkeypatch):
+    monkeypatch.setattr(bulk_enroll.AdaptiveThrottle, "wait", lambda self: None)
+
+
+def run(tmp_path, items, rekognition, db, **kwargs):
+    checkpoint = Checkpoint(str(tmp_path / "job.json"))
+    results = list(enroll_faces(items, rekognition, "col", db, str(tmp_path), checkpoint, **kwargs))
+    return results, checkpoint
+
+
+def by_status(results):
+    statuses = {}
+    for result in results:
+        statuses.setdefault(result["status"], []).append(result["uid"])
+    return statuses
+
+
+def test_enrolls_and_streams_indexed_before_enrolled(tmp_path):
+    rekognition, db = FakeRekognition(), FakeFirestore()
+    results, checkpoint = run(tmp_path, entries("a", "b", "c"), rekognition, db)
+
+    statuses = by_status(results)
+    assert sorted(statuses["indexed"]) == ["a", "b", "c"]
+    assert sorted(statuses["enrolled"]) == ["a", "b", "c"]
+    assert [r["status"] for r in results].index("enrolled") >= 3
+    assert len(db.committed) == 1 and sorted(db.committed[0]) == ["a", "b", "c"]
+    assert checkpoint.state == {"a": "done", "b": "done", "c": "done"}
+    assert (tmp_path / "a.jpg").read_bytes() == b"imagen"
+
+
+def test_results_stream_while_indexing(tmp_path):
+    rekognition, db = FakeRekognition(), FakeFirestore()
+    checkpoint = Checkpoint(str(tmp_path / "job.json"))
+    stream = enroll_faces(entries(*"abcdef"), rekognition, "col", db, str(tmp_path), checkpoint,
+                          max_workers=1)
+
+    first = next(stream)
+    assert first == {"uid": "a", "status": "indexed"}
+    assert len(rekognition.calls) < 6
+    stream.close()
+
+
+def test_firestore_commits_on_interval_without_full_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_enroll, "FIRESTORE_FLUSH_SECONDS", 0)
+    db = FakeFirestore()
+    results, _ = run(tmp_path, entries("a", "b", "c"), FakeRekognition(), db, max_workers=1)
+
+    assert db.committed == [["a"], ["b"], ["c"]]
+    assert [r["status"] for r in results] == ["indexed", "enrolled"] * 3
+
+
+def test_duplicates_in_request_and_collection(tmp_path):
+    rekognition, db = FakeRekognition(existing={"old"}), FakeFirestore()
+    results, _ = run(tmp_path, entries("old", "a", "a", "../x", ""), rekognition, db)
+
+    statuses = by_status(results)
+    assert sorted(statuses["duplicate"]) == ["a", "old"]
+    assert sorted(statuses["error"]) == ["", "../x"]
+    assert statuses["enrolled"] == ["a"]
+    assert rekognition.calls == ["a"]
+
+
+def test_retries_throttling_errors(tmp_path):
+    rekognition = FakeRekognition(fail={"a": ["ThrottlingException", "ProvisionedThroughputExceededException"]})
+    results, _ = run(tmp_path, entries("a"), rekognition, FakeFirestore())
+
+    assert rekognition.calls == ["a", "a", "a"]
+    assert by_status(results)["enrolled"] == ["a"]
+
+
+def test_index_errors_and_missing_faces_leave_no_reference_file(tmp_path):
+    rekognition = FakeRekognition(fail={"bad": ["InvalidImageFormatException"]}, no_face={"blank"})
+    results, checkpoint = run(tmp_path, entries("bad", "blank"), rekognition, FakeFirestore())
+
+    assert sorted(by_status(results)["error"]) == ["bad", "blank"]
+    assert not (tmp_path / "bad.jpg").exists()
+    assert not (tmp_path / "blank.jpg").exists()
+    assert checkpoint.state == {}
+
+
+def test_firestore_failure_reports_indexed_and_keeps_checkpoint(tmp_path):
+    results, checkpoint = run(tmp_path, entries("a"), FakeRekognition(), FakeFirestore(fail=True))
+
+    assert {"uid": "a", "status": "indexed", "firestore": False} in results
+    assert checkpoint.state == {"a": "indexed"}
+
+
+def test_resume_commits_indexed_and_skips_done(tmp_path):
+    (tmp_path / "job.json").write_text(json.dumps({"a": "indexed", "b": "done"}))
+    rekognition, db = FakeRekognition(existing={"a", "b"}), FakeFirestore()
+    results, checkpoint = run(tmp_path, entries("a", "b", "c"), rekognition, db)
+
+    statuses = by_status(results)
+    assert sorted(statuses["enrolled"]) == ["a", "c"]
+    assert statuses["skipped"] == ["b"]
+    assert rekognition.calls == ["c"]
+    assert checkpoint.state == {"a": "done", "b": "done", "c": "done"}
+
+
+def make_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+def test_zip_manifest_assigns_uids():
+    archive = make_zip({
+        "manifest.json": json.dumps({"fotos/1.jpg": "uid-1", "fotos/2.png": "uid-2"}),
+        "fotos/1.jpg": b"uno",
+        "fotos/2.png": b"dos",
+        "fotos/ignorada.jpg": b"tres",
+    })
+    items = entries_from_zip(archive)
+
+    assert [(uid, size) for uid, size, _ in items] == [("uid-1", 3), ("uid-2", 3)]
+    assert items[0][2]().read() == b"uno"
+
+
+def test_zip_without_manifest_uses_filenames():
+    archive = make_zip({"a.jpg": b"x", "notas.txt": b"y", "dir/b.JPEG": b"z"})
+    assert sorted(uid for uid, _, _ in entries_from_zip(archive)) == ["a", "b"]
+
+
+def test_zip_manifest_with_missing_file_is_rejected():
+    archive = make_zip({"manifest.json": json.dumps({"falta.jpg": "uid"})})
+    with pytest.raises(ValueError):
+        entries_from_zip(archive)
+
+
+def test_oversized_zip_entry_is_rejected_per_uid(tmp_path):
+    archive = make_zip({
+        "grande.jpg": b"\0" * (bulk_enroll.MAX_IMAGE_BYTES + 1),
+        "chica.jpg": b"x",
+    })
+    rekognition = FakeRekognition()
+    results, _ = run(tmp_path, entries_from_zip(archive), rekognition, FakeFirestore())
+
+    statuses = by_status(results)
+    assert statuses["error"] == ["grande"]
+    assert statuses["enrolled"] == ["chica"]
+    assert rekognition.calls == ["chica"]